@@ -1,13 +1,26 @@
 import asyncio
+import atexit
 import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
 import json
+import sqlite3
 from typing import Dict, Optional, List, Tuple
+import numpy as np
 import pandas as pd
+import requests
 import yfinance as yf
+try:
+    from requests_cache import CachedSession
+except ImportError:  # Optional, falls back to a plain keep-alive session
+    CachedSession = None
 from telegram import Bot, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, ApplicationBuilder
+from telegram.request import HTTPXRequest
 
 # === CONFIG ===
 # Multiple chat IDs for notifications
@@ -49,7 +62,23 @@ SYMBOLS = {
 
 PERIODS = [30, 60, 180, 360]
 CHANGE_THRESHOLD = 0.02  # 2% change threshold for notifications
-STATE_FILE = Path("bot_state.json")
+LOW_TOLERANCE = 1.015  # Price within 1.5% of a period low counts as "at low"
+YF_MAX_CONCURRENCY = 8  # Max concurrent Yahoo fetch calls, and threads per yf.download
+YF_RATE_LIMIT = 8  # Max Yahoo fetch calls (a whole yf.download counts as one) started per second
+HISTORY_CACHE_TTL = 600  # Seconds before cached Yahoo history is refetched
+YF_HTTP_CACHE_TTL = 300  # Seconds Yahoo HTTP responses are served from the on-disk cache
+TELEGRAM_POOL_SIZE = 16  # Connections shared by handlers and background sends
+TELEGRAM_SEND_CONCURRENCY = 25  # Parallel broadcast sends
+TELEGRAM_SEND_RATE = 25  # Broadcast sends per second, under Telegram's ~30 msg/s limit
+REPORT_CHUNK_SIZE = 3800  # Max report message length, below Telegram's 4096 limit
+NS_PER_DAY = 86_400_000_000_000
+# Per-period arrays used by every low analysis, built once
+PERIOD_NS = np.array(PERIODS, dtype=np.int64) * NS_PER_DAY
+MIN_PERIOD_ROWS = np.maximum(10, np.array(PERIODS) // 2)  # More flexible requirement
+STATE_DB = Path("bot_state.db")
+STATE_FLUSH_INTERVAL = 5  # Seconds between checks for queued state updates
+STATE_FLUSH_QUIET = 1  # Flush once no update has been queued for this long
+STATE_FILE = Path("bot_state.json")  # Legacy state, migrated into STATE_DB; also the debug export target
 
 # === Enhanced Logging ===
 logging.basicConfig(
@@ -64,29 +93,151 @@ logger = logging.getLogger(__name__)
 
 # === State Management ===
 class StateManager:
+    """Bot state in SQLite (WAL mode), mirrored in the `state` dict for reads.
+    
+    Mutations update the dict and queue a row-level statement; flush() applies the
+    queued statements in one transaction instead of rewriting the whole state.
+    """
     def __init__(self):
+        self.db_file = STATE_DB
         self.state_file = STATE_FILE
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._pending: List[Tuple[str, tuple]] = []
+        self._last_queued = 0.0
+        self._active_users: Optional[frozenset] = None  # Rebuilt after add_user/remove_user
+        self._flush_lock = asyncio.Lock()
+        self._init_db()
         self.state = self.load_state()
+        atexit.register(self.flush)
+    
+    def _init_db(self):
+        with self._db_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode NORMAL only risks the last commits on power loss, never corruption
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS prices (symbol TEXT PRIMARY KEY, price REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id TEXT PRIMARY KEY, username TEXT, added_date TEXT, active INTEGER NOT NULL
+                );
+            """)
     
     def load_state(self) -> Dict:
-        if self.state_file.exists():
-            try:
-                with open(self.state_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"Failed to load state: {e}")
+        try:
+            with self._db_lock:
+                initialized = self._conn.execute(
+                    "SELECT 1 FROM meta WHERE key = 'schema_version'").fetchone()
+            if not initialized:
+                self._import_json()
+            return self._read_db()
+        except Exception as e:
+            logger.error(f"Failed to load state: {e}")
         return {"last_prices": {}, "last_notification": "", "alerts": {}}
     
-    def save_state(self):
+    def _import_json(self):
+        """One-time migration of the legacy bot_state.json into the database"""
+        legacy = {}
+        if self.state_file.exists():
+            with open(self.state_file, 'r') as f:
+                legacy = json.load(f)
+        with self._db_lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?)",
+                                   legacy.get("last_prices", {}).items())
+            self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                ("last_notification", legacy.get("last_notification", "")),
+                ("alerts", json.dumps(legacy.get("alerts", {}), separators=(',', ':'))),
+                ("schema_version", "1"),
+            ])
+            self._conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", [
+                (chat_id, info.get("username"), info.get("added_date"), int(info.get("active", True)))
+                for chat_id, info in legacy.get("users", {}).items()
+            ])
+        if legacy:
+            logger.info(f"Migrated {self.state_file} into {self.db_file}")
+    
+    def _read_db(self) -> Dict:
+        with self._db_lock:
+            conn = self._conn
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            state = {
+                "last_prices": dict(conn.execute("SELECT symbol, price FROM prices")),
+                "last_notification": meta.get("last_notification", ""),
+                "alerts": json.loads(meta.get("alerts") or "{}"),
+                "users": {},
+            }
+            for chat_id, username, added_date, active in conn.execute(
+                    "SELECT chat_id, username, added_date, active FROM users"):
+                state["users"][chat_id] = {
+                    "username": username,
+                    "added_date": added_date,
+                    "active": bool(active)
+                }
+        return state
+    
+    def _apply(self, statements: List[Tuple[str, tuple]]) -> bool:
         try:
-            with open(self.state_file, 'w') as f:
-                json.dump(self.state, f, indent=2)
+            with self._db_lock, self._conn:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+            return True
         except Exception as e:
             logger.error(f"Failed to save state: {e}")
+            return False
+    
+    def _queue(self, statement: Tuple[str, tuple]):
+        self._pending.append(statement)
+        self._last_queued = time.monotonic()
+    
+    def flush(self):
+        """Persist queued updates in a single transaction"""
+        statements, self._pending = self._pending, []
+        if statements and not self._apply(statements):
+            self._pending = statements + self._pending
+    
+    async def flush_async(self):
+        """Like flush(), but the SQLite transaction runs in a worker thread.
+        
+        The lock is held across the thread hop, so batches commit in the order they
+        were queued (e.g. /subscribe then /unsubscribe can't be reordered).
+        """
+        async with self._flush_lock:
+            statements, self._pending = self._pending, []
+            if statements and not await asyncio.to_thread(self._apply, statements):
+                self._pending = statements + self._pending
+    
+    async def run_flusher(self):
+        """Background task flushing queued updates once they stop arriving"""
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            if self._pending and time.monotonic() - self._last_queued > STATE_FLUSH_QUIET:
+                await self.flush_async()
+    
+    def export_json(self, path: Optional[Path] = None):
+        """Dump the in-memory state to JSON (atomic rename) for ad-hoc debugging"""
+        path = path or self.state_file
+        tmp_file = path.with_suffix('.json.tmp')
+        try:
+            # Serialize up front so the file gets a single large write, not many small ones
+            data = json.dumps(self.state, indent=2).encode('utf-8')
+            tmp_file.unlink(missing_ok=True)  # Leftover from an interrupted write
+            with open(tmp_file, 'xb', buffering=64 * 1024) as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, path)
+        except Exception as e:
+            logger.error(f"Failed to export state: {e}")
     
     def update_price(self, symbol: str, price: float):
+        """Update a price in memory and queue it, call flush() once the batch is done"""
         self.state["last_prices"][symbol] = price
-        self.save_state()
+        self._queue((
+            "INSERT INTO prices (symbol, price) VALUES (?, ?) "
+            "ON CONFLICT(symbol) DO UPDATE SET price = excluded.price",
+            (symbol, float(price))
+        ))
     
     def get_last_price(self, symbol: str) -> Optional[float]:
         return self.state["last_prices"].get(symbol)
@@ -98,7 +249,10 @@ class StateManager:
     
     def mark_notification_sent(self):
         self.state["last_notification"] = datetime.now().strftime("%Y-%m-%d")
-        self.save_state()
+        self._queue((
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_notification', ?)",
+            (self.state["last_notification"],)
+        ))
     
     def add_user(self, chat_id: str, username: str = "Unknown"):
         """Add a new user to receive notifications"""
@@ -109,62 +263,234 @@ class StateManager:
             "added_date": datetime.now().isoformat(),
             "active": True
         }
-        self.save_state()
+        self._active_users = None
+        user = self.state["users"][chat_id]
+        self._queue((
+            "INSERT OR REPLACE INTO users (chat_id, username, added_date, active) VALUES (?, ?, ?, 1)",
+            (chat_id, user["username"], user["added_date"])
+        ))
     
     def get_active_users(self) -> List[str]:
         """Get list of active user chat IDs"""
-        users = self.state.get("users", {})
-        active_users = [chat_id for chat_id, info in users.items() if info.get("active", True)]
-        # Include original CHAT_IDS for backward compatibility
-        return list(set(CHAT_IDS + active_users))
+        if self._active_users is None:
+            users = self.state.get("users", {})
+            # Include original CHAT_IDS for backward compatibility
+            self._active_users = frozenset(CHAT_IDS).union(
+                chat_id for chat_id, info in users.items() if info.get("active", True))
+        return list(self._active_users)
     
     def remove_user(self, chat_id: str):
         """Deactivate a user from receiving notifications"""
         if "users" in self.state and chat_id in self.state["users"]:
             self.state["users"][chat_id]["active"] = False
-            self.save_state()
+            self._active_users = None
+            self._queue(("UPDATE users SET active = 0 WHERE chat_id = ?", (chat_id,)))
 
 async def send_to_all_users(bot: Bot, message: str, parse_mode: str = 'Markdown'):
     """Send message to all active users"""
+    # Persist pending updates (e.g. new subscribers) before a long broadcast
+    await state_manager.flush_async()
     active_users = state_manager.get_active_users()
-    sent_count = 0
-    failed_count = 0
+    send_semaphore = asyncio.Semaphore(TELEGRAM_SEND_CONCURRENCY)
     
-    for chat_id in active_users:
-        try:
+    async def send(chat_id: str):
+        async with send_semaphore, telegram_limiter:
             await bot.send_message(chat_id=chat_id, text=message, parse_mode=parse_mode)
-            sent_count += 1
-            logger.info(f"Message sent successfully to {chat_id}")
-        except Exception as e:
+        logger.info(f"Message sent successfully to {chat_id}")
+    
+    results = await asyncio.gather(*(send(chat_id) for chat_id in active_users),
+                                   return_exceptions=True)
+    failed_count = 0
+    for chat_id, result in zip(active_users, results):
+        if isinstance(result, Exception):
             failed_count += 1
-            logger.error(f"Failed to send message to {chat_id}: {e}")
+            logger.error(f"Failed to send message to {chat_id}: {result}")
+    sent_count = len(active_users) - failed_count
     
     logger.info(f"Message delivery: {sent_count} successful, {failed_count} failed")
     return sent_count, failed_count
 
+class RateLimiter:
+    """Async token bucket allowing `max_rate` acquisitions per `time_period` seconds"""
+    def __init__(self, max_rate: float, time_period: float = 1.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = max_rate
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                refill = (now - self._last) * self.max_rate / self.time_period
+                self._tokens = min(self.max_rate, self._tokens + refill)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.time_period / self.max_rate)
+    
+    async def __aenter__(self):
+        await self.acquire()
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
 state_manager = StateManager()
+# Bounded concurrency plus a steady call rate keeps Yahoo from answering with 429s.
+# These gate fetch calls; the requests inside one yf.download are bounded by its
+# threads=YF_MAX_CONCURRENCY
+yf_semaphore = asyncio.Semaphore(YF_MAX_CONCURRENCY)
+yf_limiter = RateLimiter(YF_RATE_LIMIT, 1.0)
+telegram_limiter = RateLimiter(TELEGRAM_SEND_RATE, 1.0)
+# One keep-alive session and Ticker per symbol, so TLS handshakes are reused.
+# With requests-cache installed, identical Yahoo queries within YF_HTTP_CACHE_TTL
+# (e.g. /report, /detailed and the monitor) are answered from .yf_http_cache.sqlite
+if CachedSession is not None:
+    yf_session = CachedSession('.yf_http_cache', backend='sqlite',
+                               expire_after=YF_HTTP_CACHE_TTL, allowable_codes=(200,))
+else:
+    yf_session = requests.Session()
+# One yf.download (YF_MAX_CONCURRENCY threads) can run next to the other gated
+# single-symbol fetches; the default pool of 10 drops connections and redoes the handshakes
+yf_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=2 * YF_MAX_CONCURRENCY))
+# yf.download keeps its results in module-global state (yfinance.shared._DFS),
+# so two downloads running at once mix up or lose each other's frames
+_download_lock = threading.Lock()
+_ticker_cache: Dict[str, yf.Ticker] = {}
+# (symbol, period) -> (time.monotonic() of fetch, history)
+_history_cache: Dict[Tuple[str, str], Tuple[float, pd.DataFrame]] = {}
 
 # === Enhanced Price Fetching & Analysis ===
-async def fetch_low_analysis(symbol: str) -> Optional[Dict]:
-    """Fetch price data and analyze lows for different periods"""
+@dataclass
+class PeriodStat:
+    """Low analysis for one lookback period; all None when data is insufficient"""
+    low: Optional[float] = None
+    is_low: Optional[bool] = None
+    date: Optional[str] = None
+    days_since: Optional[int] = None
+
+def yf_ticker(symbol: str) -> yf.Ticker:
+    """Shared Ticker per symbol, bound to the keep-alive session"""
+    if symbol not in _ticker_cache:
+        _ticker_cache[symbol] = yf.Ticker(symbol, session=yf_session)
+    return _ticker_cache[symbol]
+
+def cached_history(symbol: str, period: str, ttl: float = HISTORY_CACHE_TTL) -> Optional[pd.DataFrame]:
+    """History fetched less than `ttl` seconds ago, or None"""
+    entry = _history_cache.get((symbol, period))
+    if entry and time.monotonic() - entry[0] < ttl:
+        return entry[1]
+    return None
+
+def yf_history(symbol: str, period: str, ttl: float = HISTORY_CACHE_TTL) -> pd.DataFrame:
+    """Ticker.history, served from memory when fetched within the last `ttl` seconds"""
+    hist = cached_history(symbol, period, ttl)
+    if hist is None:
+        hist = yf_ticker(symbol).history(period=period)
+        _history_cache[(symbol, period)] = (time.monotonic(), hist)
+    return hist
+
+def download_histories(symbols: List[str], period: str) -> Dict[str, pd.DataFrame]:
+    """Download history for several symbols with a single yf.download request.
+    
+    Results go into the same in-memory cache as yf_history, so repeated
+    commands (/report then /detailed) don't hit Yahoo again. Downloads are
+    serialized by _download_lock, yf.download is not safe to run concurrently.
+    The cache is checked again under the lock, so symbols a concurrent caller
+    has just downloaded are returned from it instead of being fetched twice.
+    """
+    histories = {}
+    with _download_lock:
+        missing = []
+        for symbol in symbols:
+            hist = cached_history(symbol, period)
+            if hist is not None:
+                histories[symbol] = hist
+            else:
+                missing.append(symbol)
+        if not missing:
+            return histories
+        data = yf.download(missing, period=period, group_by='ticker', auto_adjust=True,
+                           threads=YF_MAX_CONCURRENCY, progress=False, session=yf_session)
+    fetched_at = time.monotonic()
+    for symbol in missing:
+        try:
+            hist = data[symbol] if isinstance(data.columns, pd.MultiIndex) else data
+        except KeyError:
+            continue
+        # Batched frames share one index, drop the days this symbol didn't trade
+        hist = hist.dropna(how='all')
+        if not hist.empty:
+            histories[symbol] = hist
+            _history_cache[(symbol, period)] = (fetched_at, hist)
+    return histories
+
+async def fetch_all_histories(period: str = "2y", symbols: Optional[List[str]] = None) -> Dict[str, pd.DataFrame]:
+    """Fetch history for all SYMBOLS (or `symbols`), downloading only what isn't
+    cached with a single yf.download"""
+    symbols = list(SYMBOLS.values()) if symbols is None else symbols
+    histories = {}
+    missing = []
+    for symbol in symbols:
+        hist = cached_history(symbol, period)
+        if hist is not None:
+            histories[symbol] = hist
+        else:
+            missing.append(symbol)
+    
+    if missing:
+        try:
+            async with yf_semaphore, yf_limiter:
+                histories.update(await asyncio.to_thread(download_histories, missing, period))
+        except Exception as e:
+            logger.error(f"Batch download failed for {', '.join(missing)}: {e}")
+    
+    # Symbols the batch dropped get one individual retry
+    dropped = [symbol for symbol in missing if symbol not in histories]
+    for symbol, hist in zip(dropped, await asyncio.gather(*(fetch_history(symbol, period)
+                                                             for symbol in dropped))):
+        if hist is not None:
+            histories[symbol] = hist
+    logger.info(f"✅ {period} history for {len(histories)}/{len(symbols)} symbols "
+                f"({len(symbols) - len(missing)} cached)")
+    return histories
+
+async def fetch_history(symbol: str, period: str = "2y") -> Optional[pd.DataFrame]:
+    """Fetch a single symbol's history, used when it is missing from the batch.
+    
+    A single 2y request covers every window in PERIODS, so there is no fallback
+    to shorter periods; an empty result means Yahoo has no data for the symbol.
+    """
+    try:
+        async with yf_semaphore, yf_limiter:
+            full_hist = await asyncio.to_thread(yf_history, symbol, period)
+    except Exception as e:
+        logger.warning(f"Failed to fetch {period} data for {symbol}: {e}")
+        return None
+    
+    if full_hist.empty or 'Low' not in full_hist.columns:
+        return None
+    logger.info(f"✅ Fetched {period} history for {symbol} ({len(full_hist)} rows)")
+    return full_hist
+
+def analyze_lows(symbol: str, full_hist: Optional[pd.DataFrame],
+                 now_utc: Optional[pd.Timestamp] = None) -> Optional[Dict]:
+    """Analyze lows for different periods from prefetched history (no I/O).
+    
+    `now_utc` (tz-aware UTC) is taken once per report by the caller.
+    """
     try:
-        ticker = yf.Ticker(symbol)
-        
-        # Try different periods to get data
-        full_hist = None
-        for period in ["2y", "1y", "6mo", "3mo"]:
-            try:
-                full_hist = ticker.history(period=period)
-                if not full_hist.empty and 'Low' in full_hist.columns and len(full_hist) > 50:
-                    logger.info(f"✅ Fetched {period} history for {symbol} ({len(full_hist)} rows)")
-                    break
-            except Exception as e:
-                logger.warning(f"Failed to fetch {period} data for {symbol}: {e}")
-        
         if full_hist is None or full_hist.empty:
             logger.error(f"❌ No data available for {symbol}")
             return None
         
+        # searchsorted below assumes a sorted index (yfinance normally returns one)
+        if not full_hist.index.is_monotonic_increasing:
+            full_hist = full_hist.sort_index()
+        
         current_price = full_hist['Close'].iloc[-1]
         volume = full_hist['Volume'].iloc[-1] if 'Volume' in full_hist.columns else 0
         
@@ -172,7 +498,8 @@ async def fetch_low_analysis(symbol: str) -> Optional[Dict]:
             'current': round(current_price, 2),
             'volume': int(volume),
             'change_1d': 0,
-            'symbol': symbol
+            'symbol': symbol,
+            'stats': {}
         }
         
         # Calculate 1-day change
@@ -180,44 +507,52 @@ async def fetch_low_analysis(symbol: str) -> Optional[Dict]:
             prev_close = full_hist['Close'].iloc[-2]
             result['change_1d'] = round(((current_price - prev_close) / prev_close) * 100, 2)
         
-        # Timezone handling
-        now = pd.Timestamp.now()
-        if full_hist.index.tz is not None:
-            now = now.tz_localize(full_hist.index.tz)
+        # Timezone handling: "now" in the index's timezone, or naive for a naive index
+        if now_utc is None:
+            now_utc = pd.Timestamp.now(tz='UTC')
+        tz = full_hist.index.tz
+        now = now_utc.tz_convert(tz) if tz is not None else now_utc.tz_localize(None)
+        today = now.date()
         
-        # Analyze lows for different periods
-        for days in PERIODS:
-            try:
-                start_date = now - pd.Timedelta(days=days)
-                filtered = full_hist.loc[full_hist.index >= start_date]
-                
-                min_required_days = max(10, int(0.5 * days))  # More flexible requirement
-                if len(filtered) < min_required_days:
-                    logger.warning(f"Insufficient data for {symbol} {days}D: {len(filtered)} rows")
-                    result[f'low_{days}'] = None
-                    result[f'is_low_{days}'] = None
-                    result[f'low_date_{days}'] = None
-                    result[f'days_since_low_{days}'] = None
-                    continue
-                
-                low_price = filtered['Low'].min()
-                low_date = filtered['Low'].idxmin()
-                days_since_low = (now.date() - low_date.date()).days
-                
-                # More nuanced "at low" detection (within 1.5%)
-                is_at_low = current_price <= low_price * 1.015
-                
-                result[f'low_{days}'] = round(low_price, 2)
-                result[f'is_low_{days}'] = is_at_low
-                result[f'low_date_{days}'] = low_date.strftime('%Y-%m-%d')
-                result[f'days_since_low_{days}'] = days_since_low
-                
-            except Exception as e:
-                logger.error(f"Error analyzing {days}D low for {symbol}: {e}")
-                result[f'low_{days}'] = None
-                result[f'is_low_{days}'] = None
-                result[f'low_date_{days}'] = None
-                result[f'days_since_low_{days}'] = None
+        lows = full_hist['Low'].dropna()
+        
+        # Analyze lows for all periods at once, window starts found on the raw
+        # int64 nanosecond index (UTC for tz-aware indexes, as is now.value);
+        # as_unit guards against indexes stored at another resolution
+        start_idx = np.searchsorted(lows.index.as_unit('ns').asi8,
+                                    now.as_unit('ns').value - PERIOD_NS)
+        window_rows = len(lows) - start_idx
+        valid = window_rows >= MIN_PERIOD_ROWS
+        
+        if valid.any():
+            start_idx = np.minimum(start_idx, len(lows) - 1)  # Keep invalid periods in bounds
+            # Suffix minimum over the longest window only (rev_cummin[i] == min(window[i:])),
+            # so every period is a single lookup instead of a slice + min
+            first = start_idx.min()
+            window = lows.to_numpy()[first:]
+            rev_cummin = np.minimum.accumulate(window[::-1])[::-1]
+            # Rows where a suffix minimum is attained; the first one at or after a
+            # period's start is that period's idxmin
+            min_positions = np.flatnonzero(window == rev_cummin)
+            offsets = start_idx - first
+            period_lows = rev_cummin[offsets]
+            low_dates = lows.index[first + min_positions[np.searchsorted(min_positions, offsets)]]
+            days_since = today.toordinal() - np.array([d.toordinal() for d in low_dates.date])
+            # More nuanced "at low" detection (within 1.5%)
+            is_at_low = current_price <= period_lows * LOW_TOLERANCE
+        
+        for i, days in enumerate(PERIODS):
+            if not valid[i]:
+                logger.warning(f"Insufficient data for {symbol} {days}D: {window_rows[i]} rows")
+                result['stats'][days] = PeriodStat()
+                continue
+            
+            result['stats'][days] = PeriodStat(
+                low=round(float(period_lows[i]), 2),
+                is_low=bool(is_at_low[i]),
+                date=low_dates[i].strftime('%Y-%m-%d'),
+                days_since=int(days_since[i])
+            )
         
         return result
         
@@ -225,101 +560,147 @@ async def fetch_low_analysis(symbol: str) -> Optional[Dict]:
         logger.error(f"Error fetching data for {symbol}: {e}")
         return None
 
-def detect_significant_changes() -> List[Tuple[str, str, float, float]]:
+async def detect_significant_changes() -> List[Tuple[str, str, float, float]]:
     """Detect significant price changes since last check"""
-    changes = []
+    # Same 2y frames as the reports, so a check and a report share one download
+    # (whichever runs first fills the cache); only the last two rows matter here
+    histories = {symbol: hist.tail(2) for symbol, hist in (await fetch_all_histories("2y")).items()}
+    names = {symbol: name for name, symbol in SYMBOLS.items()}
+    
+    # Latest close vs. last known price for all symbols, compared in one vectorized pass
+    current = pd.Series({symbol: histories[symbol]['Close'].iloc[-1]
+                         for symbol in SYMBOLS.values() if symbol in histories}, dtype=float).dropna()
+    prev = pd.Series({symbol: state_manager.get_last_price(symbol) for symbol in current.index}, dtype=float)
+    prices_df = pd.DataFrame({'current': current, 'prev': prev}).dropna()
+    mask = ((prices_df.current - prices_df.prev) / prices_df.prev).abs() >= CHANGE_THRESHOLD
+    changes = [(names[row.Index], row.Index, row.prev, row.current)
+               for row in prices_df[mask].itertuples()]
     
-    for name, symbol in SYMBOLS.items():
+    for symbol, current_price in current.items():
         try:
-            ticker = yf.Ticker(symbol)
-            current_data = ticker.history(period="2d")
-            
-            if len(current_data) < 1:
-                continue
-                
-            current_price = current_data['Close'].iloc[-1]
-            last_known_price = state_manager.get_last_price(symbol)
-            
-            if last_known_price is not None:
-                change_pct = abs((current_price - last_known_price) / last_known_price)
-                if change_pct >= CHANGE_THRESHOLD:
-                    changes.append((name, symbol, last_known_price, current_price))
-            
             state_manager.update_price(symbol, current_price)
-            
         except Exception as e:
             logger.error(f"Error checking changes for {symbol}: {e}")
     
+    await state_manager.flush_async()
     return changes
 
-async def build_report(detailed: bool = True) -> str:
-    """Build comprehensive market report"""
-    report = f"📊 *Market Report - {datetime.now().strftime('%d/%m/%Y %H:%M')}*\n\n"
+def split_message(text: str, limit: int = REPORT_CHUNK_SIZE) -> List[str]:
+    """Split a message into Telegram-sized parts on blank lines ("\n\n").
+    
+    Entries in our messages are separated by blank lines, so parts never cut
+    through a Markdown entity.
+    """
+    parts = []
+    current = []
+    current_len = 0
+    for section in text.split("\n\n"):
+        if not section.strip():
+            continue  # Telegram rejects empty messages
+        # current_len is the joined length, the separator only goes between sections
+        if current and current_len + 2 + len(section) > limit:
+            parts.append("\n\n".join(current))
+            current = []
+            current_len = 0
+        current_len += len(section) + (2 if current else 0)
+        current.append(section)
+    if current:
+        parts.append("\n\n".join(current))
+    return parts
+
+async def build_report(detailed: bool = True) -> List[str]:
+    """Build comprehensive market report, split into Telegram-sized messages.
+    
+    Chunks are cut between symbol blocks / alert lines as the report is built,
+    so a message never ends in the middle of a Markdown entity.
+    """
+    now_utc = pd.Timestamp.now(tz='UTC')
+    chunks = []
+    current = [f"📊 *Market Report - {datetime.now().strftime('%d/%m/%Y %H:%M')}*\n\n"]
+    current_len = len(current[0])
+    
+    def add_block(block: str):
+        nonlocal current_len
+        if current and current_len + len(block) > REPORT_CHUNK_SIZE:
+            chunks.append("".join(current))
+            current.clear()
+            current_len = 0
+        current.append(block)
+        current_len += len(block)
     
     at_lows = []
-    notable_moves = []
+    daily_changes = {}
+    
+    # One batched download, then analyze the in-memory frames in worker threads
+    # so the event loop keeps serving other commands (results keep SYMBOLS order)
+    histories = await fetch_all_histories("2y")
+    analyses = await asyncio.gather(*(asyncio.to_thread(analyze_lows, symbol, histories.get(symbol), now_utc)
+                                      for symbol in SYMBOLS.values()),
+                                    return_exceptions=True)
     
-    for name, symbol in SYMBOLS.items():
-        data = await fetch_low_analysis(symbol)
+    for (name, symbol), data in zip(SYMBOLS.items(), analyses):
+        if isinstance(data, Exception):
+            logger.error(f"Analysis failed for {symbol}: {data}")
+            data = None
         if not data:
             if detailed:
-                report += f"❌ *{name}* ({symbol}): Data unavailable\n\n"
+                add_block(f"❌ *{name}* ({symbol}): Data unavailable\n\n")
             continue
         
         # Check if at any significant lows
-        low_periods = []
-        for days in PERIODS:
-            if data.get(f'is_low_{days}'):
-                low_periods.append(f"{days}D")
+        stats = data['stats']
+        low_periods = [f"{days}D" for days, stat in stats.items() if stat.is_low]
         
         if low_periods:
             at_lows.append(f"🔻 *{name}*: At {', '.join(low_periods)} low(s)")
         
-        # Notable daily moves
         change_1d = data.get('change_1d', 0)
-        if abs(change_1d) >= 2:  # 2%+ move
-            emoji = "🟢" if change_1d > 0 else "🔴"
-            notable_moves.append(f"{emoji} *{name}*: {change_1d:+.1f}%")
+        daily_changes[name] = change_1d
         
         if detailed:
-            report += f"📈 *{name}* ({symbol})\n"
-            report += f"💰 Current: ${data['current']} ({change_1d:+.1f}%)\n"
+            block = [
+                f"📈 *{name}* ({symbol})\n",
+                f"💰 Current: ${data['current']} ({change_1d:+.1f}%)\n"
+            ]
             
-            for days in PERIODS:
-                low = data.get(f'low_{days}')
-                is_low = data.get(f'is_low_{days}')
-                days_since = data.get(f'days_since_low_{days}')
-                
-                if low is None:
-                    report += f"❔ {days}D: No data\n"
-                elif is_low:
-                    report += f"🔻 *At {days}D Low*: ${low:.2f} (today)\n"
+            for days, stat in stats.items():
+                if stat.low is None:
+                    block.append(f"❔ {days}D: No data\n")
+                elif stat.is_low:
+                    block.append(f"🔻 *At {days}D Low*: ${stat.low:.2f} (today)\n")
                 else:
-                    report += f"✅ Above {days}D low: ${low:.2f} ({days_since}d ago)\n"
+                    block.append(f"✅ Above {days}D low: ${stat.low:.2f} ({stat.days_since}d ago)\n")
             
-            report += "\n"
+            block.append("\n")
+            add_block("".join(block))
+    
+    # Notable daily moves (2%+), filtered over all symbols at once
+    moves = pd.Series(daily_changes, dtype=float)
+    notable_moves = [f"{'🟢' if change > 0 else '🔴'} *{name}*: {change:+.1f}%"
+                     for name, change in moves[moves.abs() >= 2].items()]
     
     # Summary section
     if at_lows or notable_moves:
-        report += "🚨 *KEY ALERTS*\n\n"
+        add_block("🚨 *KEY ALERTS*\n\n")
         
         if at_lows:
-            report += "💡 *At Historical Lows:*\n"
+            add_block("💡 *At Historical Lows:*\n")
             for alert in at_lows:
-                report += f"{alert}\n"
-            report += "\n"
+                add_block(f"{alert}\n")
+            add_block("\n")
         
         if notable_moves:
-            report += "📈 *Notable Moves Today:*\n"
+            add_block("📈 *Notable Moves Today:*\n")
             for move in notable_moves:
-                report += f"{move}\n"
-            report += "\n"
+                add_block(f"{move}\n")
+            add_block("\n")
     
     if not detailed:
-        report += f"\nUse /detailed for full analysis"
+        add_block(f"\nUse /detailed for full analysis")
     
-    report += "\n📝 *Note:* Prices are for ETFs tracking the indices/sectors"
-    return report
+    add_block("\n📝 *Note:* Prices are for ETFs tracking the indices/sectors")
+    chunks.append("".join(current))
+    return chunks
 
 # === Enhanced Bot Commands ===
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -343,8 +724,8 @@ I'll automatically notify you of:
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏳ Generating market summary...")
     try:
-        report = await build_report(detailed=False)
-        await update.message.reply_text(report, parse_mode='Markdown')
+        for chunk in await build_report(detailed=False):
+            await update.message.reply_text(chunk, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error in report command: {e}")
         await update.message.reply_text("❌ Failed to generate report. Please try again.")
@@ -352,14 +733,9 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def detailed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏳ Building detailed analysis...")
     try:
-        report = await build_report(detailed=True)
-        # Split long messages
-        if len(report) > 4000:
-            parts = [report[i:i+4000] for i in range(0, len(report), 4000)]
-            for part in parts:
-                await update.message.reply_text(part, parse_mode='Markdown')
-        else:
-            await update.message.reply_text(report, parse_mode='Markdown')
+        # Already split into message-sized chunks
+        for chunk in await build_report(detailed=True):
+            await update.message.reply_text(chunk, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error in detailed command: {e}")
         await update.message.reply_text("❌ Failed to generate detailed report.")
@@ -367,20 +743,23 @@ async def detailed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def alerts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔍 Checking for significant changes...")
     try:
-        changes = detect_significant_changes()
+        changes = await detect_significant_changes()
         
         if not changes:
             await update.message.reply_text("✅ No significant changes detected since last check.")
             return
         
-        alert_msg = "🚨 *Significant Changes Detected:*\n\n"
+        lines = ["🚨 *Significant Changes Detected:*\n\n"]
         for name, symbol, old_price, new_price in changes:
             change_pct = ((new_price - old_price) / old_price) * 100
             emoji = "🟢" if change_pct > 0 else "🔴"
-            alert_msg += f"{emoji} *{name}*\n"
-            alert_msg += f"${old_price:.2f} → ${new_price:.2f} ({change_pct:+.1f}%)\n\n"
+            lines.append(f"{emoji} *{name}*\n")
+            lines.append(f"${old_price:.2f} → ${new_price:.2f} ({change_pct:+.1f}%)\n\n")
+        alert_msg = "".join(lines)
         
-        await update.message.reply_text(alert_msg, parse_mode='Markdown')
+        # Sent in order, one part after another
+        for part in split_message(alert_msg):
+            await update.message.reply_text(part, parse_mode='Markdown')
         
     except Exception as e:
         logger.error(f"Error in alerts command: {e}")
@@ -392,6 +771,7 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name or "Unknown"
     
     state_manager.add_user(chat_id, username)
+    await state_manager.flush_async()
     
     await update.message.reply_text(
         f"✅ *Subscribed Successfully!*\n\n"
@@ -411,6 +791,7 @@ async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     username = update.effective_user.username or update.effective_user.first_name or "Unknown"
     
     state_manager.remove_user(chat_id)
+    await state_manager.flush_async()
     
     await update.message.reply_text(
         f"❌ *Unsubscribed*\n\n"
@@ -432,7 +813,7 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     active_users = state_manager.get_active_users()
     users_info = state_manager.state.get("users", {})
     
-    user_list = f"👥 *Subscribed Users* ({len(active_users)} total)\n\n"
+    lines = [f"👥 *Subscribed Users* ({len(active_users)} total)\n\n"]
     
     for i, user_chat_id in enumerate(active_users, 1):
         user_info = users_info.get(user_chat_id, {})
@@ -446,11 +827,13 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
         
-        user_list += f"{i}. @{username}\n"
-        user_list += f"   🆔 {user_chat_id}\n"
-        user_list += f"   📅 Added: {added_date}\n\n"
+        lines.append(f"{i}. @{username}\n")
+        lines.append(f"   🆔 {user_chat_id}\n")
+        lines.append(f"   📅 Added: {added_date}\n\n")
+    user_list = "".join(lines)
     
-    await update.message.reply_text(user_list, parse_mode='Markdown')
+    for part in split_message(user_list):
+        await update.message.reply_text(part, parse_mode='Markdown')
 
 async def test_alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test sending alerts to all users"""
@@ -502,15 +885,20 @@ async def test_9am_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Generate the daily report
-        report = await build_report(detailed=False)
-        test_report = f"🧪 *TEST - Daily Market Report*\n\n{report}\n\n_This was a test of the 9 AM daily alert system_"
+        chunks = await build_report(detailed=False)
+        chunks[0] = f"🧪 *TEST - Daily Market Report*\n\n{chunks[0]}"
+        chunks[-1] += "\n\n_This was a test of the 9 AM daily alert system_"
         
         # Send to all users
         bot = context.bot
-        sent_count, failed_count = await send_to_all_users(bot, test_report)
+        sent_count = failed_count = 0
+        for chunk in chunks:
+            chunk_sent, chunk_failed = await send_to_all_users(bot, chunk)
+            sent_count += chunk_sent
+            failed_count += chunk_failed
         
         result_msg = f"📊 *9 AM Test Results*\n\n"
-        result_msg += f"✅ Report sent to: {sent_count} users\n"
+        result_msg += f"✅ Messages delivered: {sent_count} ({len(chunks)} per user)\n"
         result_msg += f"❌ Failed deliveries: {failed_count}\n"
         result_msg += f"👥 Total subscribers: {len(state_manager.get_active_users())}"
         
@@ -530,7 +918,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 👥 Active Users: {len(active_users)}
 ⏰ Check Intervals: Every 30 minutes
 📅 Last Daily Report: {state_manager.state.get('last_notification', 'Never')}
-💾 State File: {'✅ OK' if STATE_FILE.exists() else '❌ Missing'}
+💾 State DB: {'✅ OK' if STATE_DB.exists() else '❌ Missing'}
 
 *Tracked ETFs:* {len(SYMBOLS)}
 *Periods Analyzed:* {', '.join(map(str, PERIODS))} days
@@ -538,45 +926,68 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(status_msg, parse_mode='Markdown')
 
 # === Background Tasks ===
-async def automated_monitoring():
-    """Background task for continuous monitoring"""
-    bot = Bot(token=BOT_TOKEN)
+def next_monitoring_run(after: datetime) -> datetime:
+    """Next scheduled slot strictly after `after`: every :00 and :30 from 9:00 to 16:30.
     
+    The 9:00 slot sends the daily report, the others check for significant changes.
+    """
+    slot = after.replace(minute=0 if after.minute < 30 else 30, second=0, microsecond=0)
+    while True:
+        slot += timedelta(minutes=30)
+        if 9 <= slot.hour <= 16:
+            return slot
+
+async def automated_monitoring(bot: Bot):
+    """Background task for continuous monitoring, sends through the application's bot"""
+    next_run = next_monitoring_run(datetime.now())
     while True:
         try:
-            current_time = datetime.now()
+            logger.info(f"Next monitoring run at {next_run:%Y-%m-%d %H:%M}")
+            delay = (next_run - datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
             
             # Daily report at 9:00 AM
-            if current_time.hour == 9 and current_time.minute == 0:
+            if next_run.hour == 9 and next_run.minute == 0:
                 if state_manager.should_send_notification():
                     logger.info("Sending daily report...")
-                    report = await build_report(detailed=False)
-                    await bot.send_message(chat_id=CHAT_ID, text=report, parse_mode='Markdown')
+                    for chunk in await build_report(detailed=False):
+                        await bot.send_message(chat_id=CHAT_ID, text=chunk, parse_mode='Markdown')
                     state_manager.mark_notification_sent()
             
             # Check for significant changes every 30 minutes during market hours
-            elif current_time.hour >= 9 and current_time.hour <= 16 and current_time.minute % 30 == 0:
-                changes = detect_significant_changes()
+            else:
+                changes = await detect_significant_changes()
                 if changes:
-                    alert_msg = "🚨 *Market Alert - Significant Changes:*\n\n"
+                    lines = ["🚨 *Market Alert - Significant Changes:*\n\n"]
                     for name, symbol, old_price, new_price in changes:
                         change_pct = ((new_price - old_price) / old_price) * 100
                         emoji = "🟢" if change_pct > 0 else "🔴"
-                        alert_msg += f"{emoji} *{name}*: {change_pct:+.1f}%\n"
+                        lines.append(f"{emoji} *{name}*: {change_pct:+.1f}%\n")
                     
-                    await bot.send_message(chat_id=CHAT_ID, text=alert_msg, parse_mode='Markdown')
+                    await bot.send_message(chat_id=CHAT_ID, text="".join(lines), parse_mode='Markdown')
             
-            await asyncio.sleep(60)  # Check every minute
+            await state_manager.flush_async()
             
         except Exception as e:
             logger.error(f"Error in automated monitoring: {e}")
-            await asyncio.sleep(300)  # Wait 5 minutes on error
+        
+        # Schedule from the slot just handled (not the wall clock) so an early
+        # wakeup can't fire the same slot twice; slots missed by a slow run are skipped
+        next_run = next_monitoring_run(max(next_run, datetime.now()))
 
 async def main():
     """Main function to run the bot"""
     try:
         # Build application
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
+        app = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(True)
+            .request(HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+            .get_updates_request(HTTPXRequest(connection_pool_size=8))
+            .build()
+        )
         
         # Add command handlers
         app.add_handler(CommandHandler("start", start_command))
@@ -596,20 +1007,23 @@ async def main():
         logger.info(f"Monitoring {len(SYMBOLS)} ETFs")
         logger.info(f"Sending notifications to chat ID: {CHAT_ID}")
         
-        # Start background monitoring task
-        monitoring_task = asyncio.create_task(automated_monitoring())
-        
         # Run the bot
         async with app:
             await app.start()
             await app.updater.start_polling(drop_pending_updates=True)
             
+            # Start background monitoring task, sharing the app's connection pool
+            monitoring_task = asyncio.create_task(automated_monitoring(app.bot))
+            flusher_task = asyncio.create_task(state_manager.run_flusher())
+            
             try:
                 # Keep the application running
                 await asyncio.gather(monitoring_task)
             except KeyboardInterrupt:
                 logger.info("Received interrupt signal, shutting down...")
             finally:
+                flusher_task.cancel()
+                await state_manager.flush_async()
                 await app.updater.stop()
                 await app.stop()
         
@@ -1,11 +1,18 @@
 import asyncio
 import logging
-from datetime import datetime, time
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
 import yfinance as yf
+import numpy as np
 import pandas as pd
-from telegram import Bot
+import requests
+try:
+    from requests_cache import CachedSession
+except ImportError:  # אופציונלי - בלעדיו משתמשים ב-Session רגיל
+    CachedSession = None
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-import pytz
+from zoneinfo import ZoneInfo
 
 # הגדרת לוגים
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -16,8 +23,8 @@ try:
     from config import BOT_TOKEN, CHAT_ID, SYMBOLS, DAILY_REPORT_HOUR, DAILY_REPORT_MINUTE, TIMEZONE
 except ImportError:
     # הגדרות ברירת מחדל אם אין קובץ config
-    BOT_TOKEN = "7879596687:AAF_0ckeFXnX5Wgs0j93oGp0suXwgr5BTZQ"
-    CHAT_ID = "932734805" 
+    BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
+    CHAT_ID = "YOUR_CHAT_ID_HERE"
     TIMEZONE = 'Asia/Jerusalem'
     DAILY_REPORT_HOUR = 9
     DAILY_REPORT_MINUTE = 0
@@ -33,100 +40,195 @@ except ImportError:
         'iShares Global Tech': 'IXN'
     }
 
+ISRAEL_TZ = ZoneInfo(TIMEZONE)
+FETCH_WORKERS = 8  # משיכות בודדות במקביל
+HTTP_CACHE_TTL = 6 * 3600  # נרות יומיים - מטמון HTTP של 6 שעות
+LOW_PERIODS = (20, 52)  # תקופות בדיקת LOW
+BROADCAST_BATCH_SIZE = 25  # הודעות לשנייה - מתחת למגבלה של טלגרם (~30)
+REPORT_CACHE_TTL = 15 * 60  # שניות - דוח שנבנה לאחרונה משמש גם לבקשות /report הבאות
+# מילות מפתח שיפעילו דוח
+TRIGGER_PATTERN = re.compile(r'דוח|מדדים|שוק|מחירים|נתונים|report|market', re.IGNORECASE)
+
 class MarketAnalyzer:
     def __init__(self):
         self.symbols = SYMBOLS
+        # סגירות אחרונות של כל הסימבולים במערך float32 אחד (סימבול × יום), מיושר לימין
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols.values())}
+        self.closes = np.full((len(self.symbol_index), max(LOW_PERIODS)), np.nan, dtype=np.float32)
+        # Session אחד לכל הבקשות; עם requests-cache בקשות חוזרות נענות מ-.yf_report_cache.sqlite
+        if CachedSession is not None:
+            self.session = CachedSession('.yf_report_cache', backend='sqlite',
+                                         expire_after=HTTP_CACHE_TTL, allowable_codes=(200,))
+        else:
+            self.session = requests.Session()
+        # מאגר חיבורים בגודל שמספיק לכל ה-threads של ההורדה המרוכזת ושל המשיכות הבודדות
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_maxsize=max(len(self.symbols), FETCH_WORKERS)))
     
     def get_market_data(self, symbol, period="1y"):
         """משיכת נתוני שוק עבור סימבול"""
         try:
-            ticker = yf.Ticker(symbol)
-            data = ticker.history(period=period)
+            ticker = yf.Ticker(symbol, session=self.session)
+            # רק Close נדרש לחישוב - בלי דיבידנדים/פיצולים ובלי שאר העמודות
+            data = ticker.history(period=period, actions=False)[['Close']]
             return data
         except Exception as e:
             logger.error(f"שגיאה בקבלת נתונים עבור {symbol}: {e}")
             return None
     
-    def calculate_lows(self, data, periods=[20, 52]):
-        """חישוב כמה LOW המחיר הנוכחי בתקופות שונות"""
-        if data is None or data.empty:
+    def download_all(self, period="1y"):
+        """משיכת נתוני כל הסימבולים בבקשה אחת"""
+        symbols = list(self.symbols.values())
+        try:
+            data = yf.download(symbols, period=period, group_by='ticker', auto_adjust=True,
+                               threads=True, progress=False, session=self.session)
+        except Exception as e:
+            logger.error(f"שגיאה בהורדה מרוכזת: {e}")
             return {}
         
-        current_price = data['Close'].iloc[-1]
-        results = {'current_price': current_price}
+        histories = {}
+        for symbol in symbols:
+            try:
+                history = data[symbol] if isinstance(data.columns, pd.MultiIndex) else data
+            except KeyError:
+                continue
+            # האינדקס משותף לכל הבורסות - מסירים ימים שבהם הסימבול לא נסחר
+            history = history[['Close']].dropna()
+            if not history.empty:
+                histories[symbol] = history
+        return histories
+    
+    def calculate_lows(self, histories, periods=LOW_PERIODS):
+        """חישוב כמה LOW המחיר הנוכחי בתקופות שונות - לכל הסימבולים יחד"""
+        depth = max(periods)
+        if self.closes.shape[1] < depth:
+            self.closes = np.full((len(self.symbol_index), depth), np.nan, dtype=np.float32)
+        else:
+            self.closes.fill(np.nan)
+        
+        # כל סימבול בשורה שלו עם ימי המסחר שלו, NaN לפני תחילת הנתונים
+        results = {}
+        lengths = np.zeros(len(self.symbol_index), dtype=int)
+        for symbol, data in histories.items():
+            if symbol not in self.symbol_index or data is None or data.empty:
+                continue
+            closes = data['Close'].dropna().to_numpy(dtype=np.float64)
+            if not closes.size:
+                continue
+            row = self.symbol_index[symbol]
+            tail = closes[-depth:]
+            self.closes[row, self.closes.shape[1] - tail.size:] = tail
+            lengths[row] = closes.size
+            results[symbol] = {'current_price': float(closes[-1])}
         
+        current_prices = self.closes[:, -1:]
         for period in periods:
-            if len(data) >= period:
-                # חישוב כמה ימים המחיר הנוכחי נמוך מהמחירים האחרונים
-                recent_data = data['Close'].tail(period)
-                lows_count = (current_price <= recent_data).sum()
-                results[f'{period}_week_lows'] = lows_count
-            else:
-                results[f'{period}_week_lows'] = f"לא מספיק נתונים ({len(data)} ימים)"
+            # חישוב כמה ימים המחיר הנוכחי נמוך מהמחירים האחרונים (השוואה ל-NaN היא False)
+            lows_counts = np.count_nonzero(current_prices <= self.closes[:, -period:], axis=1)
+            for symbol in results:
+                row = self.symbol_index[symbol]
+                if lengths[row] >= period:
+                    results[symbol][f'{period}_week_lows'] = int(lows_counts[row])
+                else:
+                    results[symbol][f'{period}_week_lows'] = f"לא מספיק נתונים ({lengths[row]} ימים)"
         
         return results
     
     def analyze_all_symbols(self):
         """ניתוח כל המדדים"""
         results = {}
+        histories = self.download_all()
+        
+        # סימבולים שחסרו בתשובה המרוכזת (למשל TA125.TA) - משיכות בודדות במקביל
+        missing = [symbol for symbol in self.symbols.values() if symbol not in histories]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(missing))) as executor:
+                for symbol, data in zip(missing, executor.map(self.get_market_data, missing)):
+                    if data is not None:
+                        histories[symbol] = data
         
+        lows = self.calculate_lows(histories)
         for name, symbol in self.symbols.items():
-            logger.info(f"מנתח {name} ({symbol})")
-            data = self.get_market_data(symbol)
-            
-            if data is not None:
-                analysis = self.calculate_lows(data)
-                results[name] = analysis
+            if symbol in lows:
+                results[name] = lows[symbol]
             else:
                 results[name] = {"error": "לא ניתן לקבל נתונים"}
         
         return results
     
+    # תבניות הדוח - נבנות פעם אחת ברמת המחלקה
+    REPORT_HEADER = "📊 *דוח מדדים יומי*\n🕐 {time}\n\n"
+    ERROR_TEMPLATE = "❌ *{name}*: {error}\n\n"
+    SYMBOL_TEMPLATE = "📈 *{name}*\n💰 מחיר נוכחי: {current_price:.2f}\n"
+    LOWS_TEMPLATE = "📉 {period} שבועות LOW: {lows}\n"
+    
     def format_report(self, results):
         """יצירת דוח מעוצב"""
-        report = "📊 *דוח מדדים יומי*\n"
-        report += f"🕐 {datetime.now().strftime('%d/%m/%Y %H:%M')}\n\n"
+        parts = [self.REPORT_HEADER.format(time=datetime.now(ISRAEL_TZ).strftime('%d/%m/%Y %H:%M'))]
         
         for name, data in results.items():
             if "error" in data:
-                report += f"❌ *{name}*: {data['error']}\n\n"
+                parts.append(self.ERROR_TEMPLATE.format(name=name, error=data['error']))
                 continue
             
-            current_price = data.get('current_price', 'N/A')
-            report += f"📈 *{name}*\n"
-            report += f"💰 מחיר נוכחי: {current_price:.2f}\n"
-            
-            if '20_week_lows' in data:
-                report += f"📉 20 שבועות LOW: {data['20_week_lows']}\n"
-            
-            if '52_week_lows' in data:
-                report += f"📉 52 שבועות LOW: {data['52_week_lows']}\n"
-            
-            report += "\n"
+            parts.append(self.SYMBOL_TEMPLATE.format(name=name, current_price=data['current_price']))
+            for period in LOW_PERIODS:
+                if f'{period}_week_lows' in data:
+                    parts.append(self.LOWS_TEMPLATE.format(period=period, lows=data[f'{period}_week_lows']))
+            parts.append("\n")
         
-        return report
+        return "".join(parts)
 
 class TelegramBot:
     def __init__(self, token, chat_id):
         self.token = token
         self.chat_id = chat_id
+        # CHAT_ID יכול להכיל כמה מנויים מופרדים בפסיקים
+        self.chat_ids = [cid.strip() for cid in str(chat_id).split(',') if cid.strip()]
         self.analyzer = MarketAnalyzer()
         self.application = None
-        self.israel_tz = pytz.timezone(TIMEZONE)
+        self._report = None
+        self._report_time = 0.0
+        self._report_lock = asyncio.Lock()
+    
+    async def get_report(self, refresh=False):
+        """דוח מעוצב, מהמטמון אם נבנה לפני פחות מ-REPORT_CACHE_TTL שניות.
+        
+        בקשות במקביל ממתינות על הנעילה ומקבלות את הדוח שהראשונה בנתה.
+        """
+        async with self._report_lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if refresh or self._report is None or now - self._report_time >= REPORT_CACHE_TTL:
+                # הניתוח חוסם (רשת) - רץ ב-thread כדי שהבוט ימשיך לענות בינתיים
+                results = await loop.run_in_executor(None, self.analyzer.analyze_all_symbols)
+                self._report = self.analyzer.format_report(results)
+                self._report_time = now
+            return self._report
+    
+    async def broadcast(self, text):
+        """שליחת הודעה לכל המנויים - במקביל בקבוצות של BROADCAST_BATCH_SIZE, קבוצה לשנייה"""
+        for start in range(0, len(self.chat_ids), BROADCAST_BATCH_SIZE):
+            if start:
+                await asyncio.sleep(1.0)
+            batch = self.chat_ids[start:start + BROADCAST_BATCH_SIZE]
+            # שימוש ב-Bot של ה-Application - חיבורי HTTP קיימים במקום לקוח חדש בכל דוח
+            results = await asyncio.gather(
+                *(self.application.bot.send_message(chat_id=cid, text=text, parse_mode='Markdown')
+                  for cid in batch),
+                return_exceptions=True
+            )
+            for cid, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"שגיאה בשליחה ל-{cid}: {result}")
     
     async def send_daily_report(self):
         """שליחת דוח יומי"""
         try:
             logger.info("מתחיל ניתוח יומי...")
-            results = self.analyzer.analyze_all_symbols()
-            report = self.analyzer.format_report(results)
+            report = await self.get_report(refresh=True)
             
-            bot = Bot(token=self.token)
-            await bot.send_message(
-                chat_id=self.chat_id,
-                text=report,
-                parse_mode='Markdown'
-            )
+            await self.broadcast(report)
             logger.info("דוח יומי נשלח בהצלחה")
             
         except Exception as e:
@@ -135,10 +237,11 @@ class TelegramBot:
     async def handle_report_command(self, update, context):
         """טיפול בפקודת /report"""
         try:
-            await update.message.reply_text("⏳ מכין דוח מדדים...")
-            
-            results = self.analyzer.analyze_all_symbols()
-            report = self.analyzer.format_report(results)
+            # ההודעה הראשונה נשלחת במקביל לבניית הדוח
+            _, report = await asyncio.gather(
+                update.message.reply_text("⏳ מכין דוח מדדים..."),
+                self.get_report()
+            )
             
             await update.message.reply_text(report, parse_mode='Markdown')
             
@@ -178,12 +281,7 @@ class TelegramBot:
     
     async def handle_message(self, update, context):
         """טיפול בהודעות טקסט רגילות"""
-        message_text = update.message.text.lower()
-        
-        # מילות מפתח שיפעילו דוח
-        trigger_words = ['דוח', 'מדדים', 'שוק', 'מחירים', 'נתונים', 'report', 'market']
-        
-        if any(word in message_text for word in trigger_words):
+        if TRIGGER_PATTERN.search(update.message.text):
             await self.handle_report_command(update, context)
         else:
             await update.message.reply_text(
@@ -192,23 +290,25 @@ class TelegramBot:
     
     async def schedule_daily_reports(self):
         """מתזמן דוחות יומיים"""
+        last_run_date = None
         while True:
             try:
-                now = datetime.now(self.israel_tz)
-                target_time = time(9, 0)  # 09:00 בבוקר
+                now = datetime.now(ISRAEL_TZ)
+                target_time = time(DAILY_REPORT_HOUR, DAILY_REPORT_MINUTE)
                 
-                if now.time() >= target_time:
-                    # אם עבר הזמן היום, קבע למחר
-                    next_run = now.replace(hour=9, minute=0, second=0, microsecond=0)
-                    next_run = next_run.replace(day=next_run.day + 1)
-                else:
-                    # אם עוד לא הגיע הזמן היום
-                    next_run = now.replace(hour=9, minute=0, second=0, microsecond=0)
+                # אם עבר הזמן היום (או שהדוח של היום כבר נשלח), קבע למחר
+                run_date = now.date()
+                if now.time() >= target_time or run_date == last_run_date:
+                    run_date += timedelta(days=1)
+                next_run = datetime.combine(run_date, target_time, tzinfo=ISRAEL_TZ)
                 
-                sleep_seconds = (next_run - now).total_seconds()
+                # חיסור דרך timestamp: חיסור ישיר בין שני datetime עם אותו tzinfo
+                # מתעלם מההפרש מ-UTC, ובמעבר שעון הדוח היה יוצא שעה מוקדם/מאוחר
+                sleep_seconds = next_run.timestamp() - now.timestamp()
                 logger.info(f"הדוח הבא יישלח ב: {next_run}")
                 
                 await asyncio.sleep(sleep_seconds)
+                last_run_date = run_date
                 await self.send_daily_report()
                 
             except Exception as e: